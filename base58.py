@@ -31,12 +31,21 @@
 import binascii
 import struct
 
-from crypto import SHA256, RIPEMD160
+from crypto import SHA256d, RIPEMD160
 
 
 
 base58Chars = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
 
+#Reverse lookup table: character -> digit value
+base58Values = {c: i for i, c in enumerate(base58Chars)}
+
+#In decoding, digits are combined in groups of this size, such that a group
+#fits in a native (non-long) int: 58**10 < 2**63.
+#This way, only one (slow) bignum operation is needed per group, instead of
+#one per digit.
+base58GroupSize = 10
+
 
 def encodeBase58(data):
 	"""
@@ -52,21 +61,18 @@ def encodeBase58(data):
 	# Convert big endian data to bignum
 	bignum = int('00' + data.encode("hex"), 16) #00 is necessary in case of empty string
 
-	ret = ""
+	# Collect the digits in a list, instead of growing a string one by one
+	digits = []
 	while bignum > 0:
 		bignum, remainder = divmod(bignum, 58)
-		ret = ret + base58Chars[remainder]
+		digits.append(base58Chars[remainder])
 
 	# Leading zeroes encoded as base58 zeros
-	for i in range(len(data)):
-		if data[i] != '\0':
-			break
-		ret = ret + base58Chars[0]
-
-	# Convert little endian string to big endian
-	ret = ret[::-1]
+	numZeroes = len(data) - len(data.lstrip('\0'))
 
-	return ret
+	# Convert little endian digits to big endian (in-place, without a copy)
+	digits.reverse()
+	return base58Chars[0]*numZeroes + ''.join(digits)
 
 
 def decodeBase58(data):
@@ -84,16 +90,23 @@ def decodeBase58(data):
 	"""
 
 	#Leading zeroes:
-	zeroes = ""
-	while len(data) > 0 and data[0] == base58Chars[0]:
-		zeroes += '\0'
-		data = data[1:]
+	#(stripped in one go, instead of slicing off one character at a time)
+	stripped = data.lstrip(base58Chars[0])
+	zeroes = '\0' * (len(data) - len(stripped))
+	data = stripped
 
 	#Big endian base58 decoding:
 	bignum = 0
-	for c in data:
-		digit = base58Chars.index(c)
-		bignum = 58*bignum + digit
+	for start in range(0, len(data), base58GroupSize):
+		groupData = data[start:start+base58GroupSize]
+		group = 0
+		for c in groupData:
+			try:
+				digit = base58Values[c]
+			except KeyError:
+				raise ValueError("Illegal character in base58 data: %r" % c)
+			group = 58*group + digit
+		bignum = bignum * 58**len(groupData) + group
 
 	#To big endian:
 	#First to hex:
@@ -104,8 +117,7 @@ def decodeBase58(data):
 	ret = binascii.unhexlify(ret)
 
 	#Skip zeroes:
-	while len(ret) > 0 and ret[0] == '\0':
-		ret = ret[1:]
+	ret = ret.lstrip('\0')
 
 	return zeroes + ret
 
@@ -122,7 +134,7 @@ def encodeBase58Check_noVersion(data):
 	"""
 
 	# add 4-byte hash check to the end
-	checksum = SHA256(SHA256(data))[:4]
+	checksum = SHA256d(data)[:4]
 	return encodeBase58(data + checksum)
 
 
@@ -144,7 +156,7 @@ def decodeBase58Check_noVersion(data):
 	decoded = decodeBase58(data)
 	checksum = decoded[-4:]
 	rest = decoded[:-4]
-	if checksum != SHA256(SHA256(rest))[:4]:
+	if checksum != SHA256d(rest)[:4]:
 		raise Exception("Checksum failed")
 	return rest
 
@@ -31,7 +31,7 @@ import binascii
 import decimal
 import sys
 
-from crypto import Key, SHA256, RIPEMD160
+from crypto import Key, HASH160
 import base58
 import bitcointransaction as btx
 
@@ -40,48 +40,99 @@ import bitcointransaction as btx
 BCC = 100000000 #Satoshi
 
 
+def parseAmount(amount):
+	#Converts a decimal BCC amount string to an integer amount in Satoshi.
+	#Only plain decimal notation is supported (no exponents), and amounts
+	#with more than 8 decimals are rejected.
+	s = amount.strip()
+	sign = 1
+	if s[:1] in ('-', '+'):
+		if s[0] == '-':
+			sign = -1
+		s = s[1:]
+	whole, dot, fraction = s.partition('.')
+	if not (whole + fraction).isdigit():
+		raise ValueError("Invalid amount: %r" % amount)
+	fraction = fraction.rstrip('0')
+	if len(fraction) > 8:
+		raise ValueError("Amount has more than 8 decimals: %r" % amount)
+	return sign * (int(whole or '0') * BCC + int(fraction.ljust(8, '0')))
+
+
 def readPrivateKey(filename):
 	with open(filename, "rb") as f:
-		privateKey = f.read()
-	privateKey = privateKey.split("\n")[0] #first line
+		privateKey = f.readline() #first line
 	privateKey = privateKey.strip() #ignore whitespace
 	return base58.decodeBase58Check(privateKey, 128) #PRIVKEY = 128
 
 
+def loadKey(filename):
+	privateKey = readPrivateKey(filename)
+	k = Key()
+	k.setPrivateKey(privateKey)
+	return k
+
+
+#(publicKeyHash, address) tuples, indexed by public key.
+#This way, the hashing and base58 encoding is only done once per key, even
+#though addresses are shown again on every "Address of unspent output" prompt.
+addressCache = {}
+
+
+def getAddressInfo(publicKey):
+	if publicKey not in addressCache:
+		publicKeyHash = HASH160(publicKey)
+		address = base58.encodeBase58Check(publicKeyHash, 0) #PUBKEY_ADDRESS = 0
+		addressCache[publicKey] = publicKeyHash, address
+	return addressCache[publicKey]
+
+
 def getAddress(key):
-	publicKeyHash = RIPEMD160(SHA256(key.getPublicKey()))
-	return base58.encodeBase58Check(publicKeyHash, 0) #PUBKEY_ADDRESS = 0
+	return getAddressInfo(key.getPublicKey())[1]
+
+
+#Standard scriptPubKeys, indexed by public key hash.
+#Note: the Script objects are shared, so they must not be modified.
+scriptPubKeyCache = {}
+
+
+def getStandardScriptPubKey(publicKeyHash):
+	if publicKeyHash not in scriptPubKeyCache:
+		scriptPubKeyCache[publicKeyHash] = btx.Script.standardPubKey(publicKeyHash)
+	return scriptPubKeyCache[publicKeyHash]
+
+
+def formatScriptElement(e):
+	#Data items are shown in hex; op-codes as hexadecimal numbers.
+	if isinstance(e, str):
+		return e.encode("hex")
+	return '0x%0x' % e
 
 
 def getinfo(args):
 	for filename in args:
 		print "----------------"
 		print "Filename: ", filename
-		privateKey = readPrivateKey(filename)
-		k = Key()
-		k.setPrivateKey(privateKey)
+		k = loadKey(filename)
 		print "Public key: ", k.getPublicKey().encode("hex")
 		print "Address: ", getAddress(k)
 
 
 def spend(args):
 	#Load the keys
-	keys = []
-	for filename in args:
-		privateKey = readPrivateKey(filename)
-		k = Key()
-		k.setPrivateKey(privateKey)
-		keys.append(k)
+	keys = [loadKey(fn) for fn in args]
+
+	#Derive all addresses once, instead of on every prompt:
+	addresses = [getAddress(k) for k in keys]
 
 	def getKey(question):
 		for i in range(len(keys)):
-			print i+1, getAddress(keys[i])
+			print i+1, addresses[i]
 		i = int(raw_input(question)) - 1
 		return keys[i]
 
 	#Ask for input information:
-	inputs = []
-	amounts = []
+	inputs = [] #(txid, vout, key, amount) tuples
 	while True:
 		txid = raw_input("Transaction ID of unspent output (Enter to stop): ")
 		txid = txid.strip()
@@ -91,17 +142,17 @@ def spend(args):
 
 		vout = int(raw_input("Output index of unspent output: "))
 		k = getKey("Address of unspent output: ")
-		inputs.append((txid, vout, k))
-		amounts.append(int(decimal.Decimal(
+		amount = parseAmount(
 			raw_input("Amount in unspent output (BCC): ")
-			) * BCC))
+			)
+		inputs.append((txid, vout, k, amount))
 
-	totalAmount = sum(amounts)
+	totalAmount = sum(x[3] for x in inputs)
 	print "Total of amounts: %s BCC" % str(decimal.Decimal(totalAmount)/BCC)
 
-	fee = int(decimal.Decimal(
+	fee = parseAmount(
 			raw_input("Transaction fee (BCC): ")
-			) * BCC)
+			)
 
 	destAddress = raw_input("Destination address: ")
 	destHash = base58.decodeBase58Check(destAddress, 0) #PUBKEY_ADDRESS = 0
@@ -118,13 +169,15 @@ def spend(args):
 		sys.exit(1)
 	'''
 
+	destScriptPubKey = getStandardScriptPubKey(destHash)
+
 	tx = btx.Transaction(
 		tx_in = [
 			btx.TxIn(x[0], x[1])
 			for x in inputs
 			],
 		tx_out = [
-			btx.TxOut(destAmount, btx.Script.standardPubKey(destHash))
+			btx.TxOut(destAmount, destScriptPubKey)
 			]
 		)
 
@@ -146,23 +199,24 @@ def spend(args):
 
 	for i in range(len(inputs)):
 		#print tx.tx_in[i].previousOutputHash.encode("hex"), tx.tx_in[i].previousOutputIndex
-		key = inputs[i][2]
-		address = getAddress(key)
-		hash = base58.decodeBase58Check(address, 0) #PUBKEY_ADDRESS = 0
-		scriptPubKey = btx.Script.standardPubKey(hash)
-		tx.signInput(i, scriptPubKey, [None, key.getPublicKey()], [key], amounts[i])
+		key, amount = inputs[i][2:4]
+		publicKey = key.getPublicKey()
+		publicKeyHash = getAddressInfo(publicKey)[0]
+		scriptPubKey = getStandardScriptPubKey(publicKeyHash)
+		tx.signInput(i, scriptPubKey, [None, publicKey], [key], amount)
 
 	print "Serialized transaction:"
-	print tx.serialize().encode("hex")
-	print "Transaction ID:", tx.getTransactionID()[::-1].encode("hex")
+	print binascii.hexlify(tx.serialize())
+	print "Transaction ID:", binascii.hexlify(tx.getTransactionID()[::-1])
 
 
 def decode(args):
 	s = args[0]
-	amounts = [int(decimal.Decimal(a)*BCC) for a in args[1:]]
+	amounts = [parseAmount(a) for a in args[1:]]
 	serialized = binascii.unhexlify(s)
 	tx = btx.Transaction.deserialize(serialized)
 	print 'lockTime: ', tx.lockTime
+	k = Key() #re-used for all inputs
 	for i in range(len(tx.tx_in)):
 		tx_in = tx.tx_in[i]
 		print 'TxIn:'
@@ -172,20 +226,14 @@ def decode(args):
 		print '    sequenceNumber: 0x%08x' % tx_in.sequenceNumber
 		print '    script:'
 		for e in tx_in.scriptSig.elements:
-			if isinstance(e, str):
-				s = e.encode("hex")
-			else:
-				s = str(e)
-			print '        ', s
+			print '        ', formatScriptElement(e)
 		signature, pubKey = tx_in.scriptSig.elements
 		hashType = ord(signature[-1])
 		signature = signature[:-1]
 
-		k = Key()
 		k.setPublicKey(pubKey)
-		address = getAddress(k)
-		hash = base58.decodeBase58Check(address, 0) #PUBKEY_ADDRESS = 0
-		scriptPubKey = btx.Script.standardPubKey(hash)
+		publicKeyHash, address = getAddressInfo(pubKey)
+		scriptPubKey = getStandardScriptPubKey(publicKeyHash)
 
 		sigHash = tx.getSignatureBodyHash(i, scriptPubKey, hashType, amount=amounts[i])
 
@@ -204,11 +252,7 @@ def decode(args):
 		elements = tx_out.scriptPubKey.elements
 		print '    script:'
 		for e in elements:
-			if isinstance(e, str):
-				s = e.encode("hex")
-			else:
-				s = '0x%0x' % e
-			print '        ', s
+			print '        ', formatScriptElement(e)
 
 		if len(elements) == 5 and \
 			elements[0:2] == [btx.OP.DUP, btx.OP.HASH160] and \
@@ -222,7 +266,7 @@ def decode(args):
 
 		print ''
 
-	fee = sum(amounts) - sum([tx_out.amount for tx_out in tx.tx_out])
+	fee = sum(amounts) - sum(tx_out.amount for tx_out in tx.tx_out)
 	print 'Tx fee: %s BCC' % str(decimal.Decimal(fee)/BCC)
 
 
@@ -233,13 +277,11 @@ funcs = \
 "decode": decode,
 "spend": spend,
 }
-funcNames = funcs.keys()
-funcNames.sort()
 
-if len(sys.argv) < 2 or sys.argv[1] not in funcNames:
+if len(sys.argv) < 2 or sys.argv[1] not in funcs:
 	print "Usage: %s <command> [<args>]" % sys.argv[0]
 	print "Command can be one of:"
-	for fn in funcNames:
+	for fn in sorted(funcs.keys()):
 		print fn
 	sys.exit(1)
 
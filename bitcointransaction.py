@@ -26,12 +26,19 @@
 #    such a combination shall include the source code for the parts of the
 #    OpenSSL library used as well as that of the covered work.
 
+import hashlib
 import struct
-import copy
-from crypto import SHA256
+from crypto import SHA256, SHA256d
 
 
 
+#Pre-compiled structs for the fixed-size integer types.
+#These are faster than calling struct.pack / struct.unpack with a format string.
+uint16Struct = struct.Struct('<H')
+uint32Struct = struct.Struct('<I')
+uint64Struct = struct.Struct('<Q')
+
+
 #see https://en.bitcoin.it/wiki/Transactions
 #see https://en.bitcoin.it/wiki/Protocol_specification
 #see https://en.bitcoin.it/wiki/Script
@@ -50,42 +57,48 @@ def packVarInt(i):
 	struct.error: integer out of range
 	"""
 
-	if i < 0xfd:
-		return struct.pack('B', i) #uint8_t
+	#Note: negative numbers fall through to the uint16_t case, so they also
+	#raise struct.error.
+	if 0 <= i < 0xfd:
+		return chr(i) #uint8_t
 	elif i <= 0xffff:
-		return struct.pack('B', 0xfd) + struct.pack('<H', i) #uint16_t
+		return '\xfd' + uint16Struct.pack(i) #uint16_t
 	elif i <= 0xffffffff:
-		return struct.pack('B', 0xfe) + struct.pack('<I', i) #uint32_t
+		return '\xfe' + uint32Struct.pack(i) #uint32_t
 	else:
-		return struct.pack('B', 0xff) + struct.pack('<Q', i) #uint64_t
+		return '\xff' + uint64Struct.pack(i) #uint64_t
 
 
-def unpackVarInt(data):
+def unpackVarInt(data, offset=0):
 	"""
 	Bitcoin variable length integer decoding
 
 	Arguments:
-	str; the variable-length encoded value
+	data: str; the variable-length encoded value
+	offset: int; the position in data where the encoded value starts
+	        (default: 0)
 
 	Return value:
-	i: int; the decoded integer value
+	Tuple, containing:
+	int; the decoded integer value
+	int; the number of bytes that has been read
 
 	Exceptions:
 	struct.error: unexpected end of data
 	"""
 
-	firstByte = struct.unpack('B', data[0])[0] #uint8_t
+	firstByte = ord(data[offset]) #uint8_t
 	if firstByte < 0xfd:
 		value = firstByte
 		return value, 1
 	elif firstByte == 0xfd:
-		value = struct.unpack('<H', data[1:3])[0] #uint16_t
+		value = uint16Struct.unpack_from(data, offset+1)[0] #uint16_t
 		return value, 3
 	elif firstByte == 0xfe:
-		value = struct.unpack('<I', data[1:5])[0] #uint32_t
+		value = uint32Struct.unpack_from(data, offset+1)[0] #uint32_t
 		return value, 5
 	elif firstByte == 0xff:
-		value = struct.unpack('<Q', data[1:9])[0] #uint64_t
+		value = uint64Struct.unpack_from(data, offset+1)[0] #uint64_t
 		return value, 9
 
 	raise Exception("Bug detected in unpackVarInt")
@@ -207,25 +220,28 @@ class Script:
 		Script; the de-serialized script
 		"""
 
+		#Note: a read position is kept, instead of repeatedly slicing off the
+		#part that has been read (which copies the rest of the data each time).
 		elements = []
-		while len(data) > 0:
-			opcode = struct.unpack('B', data[0])[0]
-			data = data[1:]
+		pos = 0
+		while pos < len(data):
+			opcode = ord(data[pos])
+			pos += 1
 
 			if opcode <= 0x4e:
 				if opcode <= 0x4b:
 					length = opcode
 				elif opcode == 0x4c:
-					length = struct.unpack('B', data[:1])[0]
-					data = data[1:]
+					length = struct.unpack_from('B', data, pos)[0]
+					pos += 1
 				elif opcode == 0x4d:
-					length = struct.unpack('<H', data[:2])[0]
-					data = data[2:]
+					length = uint16Struct.unpack_from(data, pos)[0]
+					pos += 2
 				else:
-					length = struct.unpack('<I', data[:4])[0]
-					data = data[4:]
-				elements.append(data[:length])
-				data = data[length:]
+					length = uint32Struct.unpack_from(data, pos)[0]
+					pos += 4
+				elements.append(data[pos:pos+length])
+				pos += length
 			else:
 				elements.append(opcode)
 
@@ -242,10 +258,16 @@ class Script:
 		"""
 		self.elements = elements
 
+		#Cached result of serialize(), and the elements it was made from:
+		self.__serializedElements = None
+		self.__serialized = None
+
 
 	def serialize(self):
 		"""
 		Serializes the script.
+		The result is cached, so repeated calls (e.g. when signing multiple
+		inputs) are cheap, as long as elements doesn't change.
 
 		Return value:
 		str; the serialized script
@@ -253,7 +275,15 @@ class Script:
 		Exceptions:
 		Exception: serialization failed
 		"""
-		return ''.join([self.__serializeElement(e) for e in self.elements])
+
+		#Since elements may be replaced or modified in-place, the cache is
+		#only used if the elements are still the same. Comparing tuples of
+		#immutable elements is much cheaper than serializing them.
+		elements = tuple(self.elements)
+		if elements != self.__serializedElements:
+			self.__serialized = ''.join([self.__serializeElement(e) for e in elements])
+			self.__serializedElements = elements
+		return self.__serialized
 
 
 	def __serializeElement(self, e):
@@ -272,17 +302,17 @@ class Script:
 
 		if isinstance(e, str):
 			if len(e) <= 0x4b:
-				return struct.pack('B', len(e)) + e
+				return chr(len(e)) + e
 			elif len(e)<= 0xff:
-				return struct.pack('B', 0x4c) + struct.pack('B', len(e)) + e
+				return '\x4c' + chr(len(e)) + e
 			elif len(e) <= 0xffff:
-				return struct.pack('B', 0x4d) + struct.pack('<H', len(e)) + e
+				return '\x4d' + uint16Struct.pack(len(e)) + e
 			elif len(e) <= 0xffffffff:
-				return struct.pack('B', 0x4e) + struct.pack('<I', len(e)) + e
+				return '\x4e' + uint32Struct.pack(len(e)) + e
 			else:
 				raise Exception('Too long data for a script item')
 		elif isinstance(e, int):
-			return struct.pack('B', e)
+			return chr(e)
 		else:
 			raise Exception('Unsupported element type in script')
 
@@ -300,7 +330,7 @@ class TxIn:
 	"""
 
 	@staticmethod
-	def deserialize(data):
+	def deserialize(data, offset=0):
 		"""
 		De-serializes a transaction input.
 		This is a static method: it can be called without having an instance,
@@ -308,8 +338,10 @@ class TxIn:
 
 		Arguments:
 		data: str; the serialized transaction input.
-		      May contain trailing bytes that are not part of the serialized
-		      transaction input.
+		      May contain leading and trailing bytes that are not part of the
+		      serialized transaction input.
+		offset: int; the position in data where the serialized transaction
+		        input starts (default: 0)
 
 		Return value:
 		Tuple, containing:
@@ -317,19 +349,21 @@ class TxIn:
 		int; the number of bytes that has been read
 		"""
 
-		outputHash = data[:32]
-		data = data[32:]
+		pos = offset
 
-		outputIndex = struct.unpack('<I', data[:4])[0] #uint32_t
-		data = data[4:]
+		outputHash = data[pos:pos+32]
+		pos += 32
 
-		scriptSigLen, numBytesInLen = unpackVarInt(data)
-		data = data[numBytesInLen:]
+		outputIndex = uint32Struct.unpack_from(data, pos)[0] #uint32_t
+		pos += 4
 
-		scriptSig = Script.deserialize(data[:scriptSigLen])
-		data = data[scriptSigLen:]
+		scriptSigLen, numBytesInLen = unpackVarInt(data, pos)
+		pos += numBytesInLen
 
-		sequenceNumber = struct.unpack('<I', data[:4])[0] #uint32_t
+		scriptSig = Script.deserialize(data[pos:pos+scriptSigLen])
+		pos += scriptSigLen
+
+		sequenceNumber = uint32Struct.unpack_from(data, pos)[0] #uint32_t
 
 		obj = TxIn(outputHash, outputIndex, sequenceNumber)
 		obj.scriptSig = scriptSig
@@ -360,14 +394,14 @@ class TxIn:
 		str; the serialized transaction input
 		"""
 
-		ret = self.previousOutputHash
-		ret += struct.pack('<I', self.previousOutputIndex) #uint32_t
 		scriptSig = self.scriptSig.serialize()
-		ret += packVarInt(len(scriptSig))
-		ret += scriptSig
-		ret += struct.pack('<I', self.sequenceNumber) #uint32_t
-
-		return ret
+		return ''.join([
+			self.previousOutputHash,
+			uint32Struct.pack(self.previousOutputIndex), #uint32_t
+			packVarInt(len(scriptSig)),
+			scriptSig,
+			uint32Struct.pack(self.sequenceNumber) #uint32_t
+			])
 
 
 
@@ -381,7 +415,7 @@ class TxOut:
 	"""
 
 	@staticmethod
-	def deserialize(data):
+	def deserialize(data, offset=0):
 		"""
 		De-serializes a transaction output.
 		This is a static method: it can be called without having an instance,
@@ -389,8 +423,10 @@ class TxOut:
 
 		Arguments:
 		data: str; the serialized transaction output.
-		      May contain trailing bytes that are not part of the serialized
-		      transaction output.
+		      May contain leading and trailing bytes that are not part of the
+		      serialized transaction output.
+		offset: int; the position in data where the serialized transaction
+		        output starts (default: 0)
 
 		Return value:
 		Tuple, containing:
@@ -398,13 +434,15 @@ class TxOut:
 		int; the number of bytes that has been read
 		"""
 
-		amount = struct.unpack('<Q', data[:8])[0] #uint64_t
-		data = data[8:]
+		pos = offset
+
+		amount = uint64Struct.unpack_from(data, pos)[0] #uint64_t
+		pos += 8
 
-		scriptPubKeyLen, numBytesInLen = unpackVarInt(data)
-		data = data[numBytesInLen:]
+		scriptPubKeyLen, numBytesInLen = unpackVarInt(data, pos)
+		pos += numBytesInLen
 
-		scriptPubKey = Script.deserialize(data[:scriptPubKeyLen])
+		scriptPubKey = Script.deserialize(data[pos:pos+scriptPubKeyLen])
 
 		obj = TxOut(amount, scriptPubKey)
 		numBytes = 8 + numBytesInLen + scriptPubKeyLen
@@ -432,12 +470,12 @@ class TxOut:
 		str; the serialized transaction output
 		"""
 
-		ret = struct.pack('<Q', self.amount) #uint64_t
 		scriptPubKey = self.scriptPubKey.serialize()
-		ret += packVarInt(len(scriptPubKey))
-		ret += scriptPubKey		
-
-		return ret
+		return ''.join([
+			uint64Struct.pack(self.amount), #uint64_t
+			packVarInt(len(scriptPubKey)),
+			scriptPubKey
+			])
 
 
 
@@ -468,26 +506,28 @@ class Transaction:
 		Exception: deserialization failed
 		"""
 
-		version = struct.unpack('<I', data[:4])[0] #version, uint32_t
-		data = data[4:]
+		#Note: a read position is kept, instead of repeatedly slicing off the
+		#part that has been read (which copies the rest of the data each time).
+		version = uint32Struct.unpack_from(data, 0)[0] #version, uint32_t
+		pos = 4
 
 		if version != 2:
 			raise Exception("Transaction deserialization failed: version != 2")
 
-		num_tx_in, numBytes = unpackVarInt(data)
-		data = data[numBytes:]
+		num_tx_in, numBytes = unpackVarInt(data, pos)
+		pos += numBytes
 		tx_in = []
 		for i in range(num_tx_in):
-			obj, numBytes = TxIn.deserialize(data)
-			data = data[numBytes:]
+			obj, numBytes = TxIn.deserialize(data, pos)
+			pos += numBytes
 			tx_in.append(obj)
 
-		num_tx_out, numBytes = unpackVarInt(data)
-		data = data[numBytes:]
+		num_tx_out, numBytes = unpackVarInt(data, pos)
+		pos += numBytes
 		tx_out = []
 		for i in range(num_tx_out):
-			obj, numBytes = TxOut.deserialize(data)
-			data = data[numBytes:]
+			obj, numBytes = TxOut.deserialize(data, pos)
+			pos += numBytes
 			tx_out.append(obj)
 
 		#To make sure we're not accepting a transaction that has been serialized
@@ -495,10 +535,10 @@ class Transaction:
 		#This might be important when making/checking signatures.
 		#It might be advisable anyway to re-serialize a received transaction and
 		#check whether the result matches the original.
-		if len(data) != 4:
+		if len(data) - pos != 4:
 			raise Exception("Transaction deserialization failed: incorrect data length")
 
-		lockTime = struct.unpack('<I', data[:4])[0] #uint32_t
+		lockTime = uint32Struct.unpack_from(data, pos)[0] #uint32_t
 
 		return Transaction(tx_in, tx_out, lockTime)
 
@@ -517,6 +557,9 @@ class Transaction:
 		self.tx_out = tx_out
 		self.lockTime = lockTime
 
+		#Cached (data, hash) pairs, see __getCachedDoubleHash:
+		self.__hashCache = {}
+
 
 	def serialize(self):
 		"""
@@ -526,17 +569,80 @@ class Transaction:
 		str; the serialized transaction
 		"""
 
-		ret = struct.pack('<I', self.version) #version, uint32_t
-		ret += packVarInt(len(self.tx_in))
-		for tx_in in self.tx_in:
-			ret += tx_in.serialize()
-		ret += packVarInt(len(self.tx_out))
-		for tx_out in self.tx_out:
-			ret += tx_out.serialize()
-		ret += struct.pack('<I', self.lockTime) #uint32_t
+		#Collect all parts in a list and join them once, instead of repeatedly
+		#copying the growing string:
+		ret = [uint32Struct.pack(self.version)] #version, uint32_t
+		ret.append(packVarInt(len(self.tx_in)))
+		ret += [tx_in.serialize() for tx_in in self.tx_in]
+		ret.append(packVarInt(len(self.tx_out)))
+		ret += [tx_out.serialize() for tx_out in self.tx_out]
+		ret.append(uint32Struct.pack(self.lockTime)) #uint32_t
+		return ''.join(ret)
+
+
+	def __getCachedDoubleHash(self, name, data):
+		"""
+		Calculates the double-SHA256 hash of data.
+		When signing multiple inputs, the same hashPrevouts, hashSequence and
+		hashOutputs data is hashed for every input, so the last result for each
+		name is kept, and re-used as long as the data doesn't change.
+
+		Arguments:
+		name: str; the name under which the result is cached
+		data: str; the to-be-hashed data
+
+		Return value:
+		str; SHA256(SHA256(data))
+		"""
+
+		cached = self.__hashCache.get(name)
+		if cached is not None and cached[0] == data:
+			return cached[1]
+
+		ret = SHA256d(data)
+		self.__hashCache[name] = data, ret
 		return ret
 
 
+	def __serializeForLegacySignature(self, index, subScript):
+		"""
+		Serializes the transaction as it would be after setting the scriptSig
+		of input index to subScript, and those of all other inputs to empty
+		scripts. The transaction itself is not modified.
+
+		Arguments:
+		index: int; the index of the transaction input that gets subScript
+		subScript: Script; the script for that transaction input
+
+		Return value:
+		str; the serialized transaction
+
+		Exceptions:
+		IndexError: index out of range
+		"""
+
+		#Same interpretation as for list indices (negative, IndexError):
+		index = xrange(len(self.tx_in))[index]
+
+		subScript = subScript.serialize()
+
+		ret = [uint32Struct.pack(self.version)] #version, uint32_t
+		ret.append(packVarInt(len(self.tx_in)))
+		for i, tx_in in enumerate(self.tx_in):
+			scriptSig = subScript if i == index else '' #Empty (zero-byte)
+			ret += [
+				tx_in.previousOutputHash,
+				uint32Struct.pack(tx_in.previousOutputIndex), #uint32_t
+				packVarInt(len(scriptSig)),
+				scriptSig,
+				uint32Struct.pack(tx_in.sequenceNumber) #uint32_t
+				]
+		ret.append(packVarInt(len(self.tx_out)))
+		ret += [tx_out.serialize() for tx_out in self.tx_out]
+		ret.append(uint32Struct.pack(self.lockTime)) #uint32_t
+		return ''.join(ret)
+
+
 	def getSignatureBodyHash(self, index, scriptPubKey, hashType=SIGHASH.ALL+SIGHASH.FORKID, amount=None):
 		"""
 		Calculates the hash of properly masked serialized data of this
@@ -575,82 +681,89 @@ class Transaction:
 			subScript = scriptPubKey
 
 			#6.	A copy is made of the current transaction (hereby referred to txCopy)
-			txCopy = copy.deepcopy(self)
-
 			#7.	The scripts for all transaction inputs in txCopy are set to empty
 			#	scripts (exactly 1 byte 0x00)
-			for tx_in in txCopy.tx_in:
-				tx_in.scriptSig = Script() #Empty (zero-byte)
-
 			#8.	The script for the current transaction input in txCopy is set to
 			#	subScript (lead in by its length as a var-integer encoded!)
-			txCopy.tx_in[index].scriptSig = subScript
+			#Instead of making txCopy, we directly serialize it:
+			txCopySerialized = self.__serializeForLegacySignature(index, subScript)
 
 			#An array of bytes is constructed from the serialized txCopy appended by
 			#four bytes for the hash type.
-			signatureBody = txCopy.serialize() + struct.pack('<I', hashType) #uint32_t
+			#Note: instead of constructing the array, it is fed into the hash
+			#function piece by piece.
+			bodyHasher = hashlib.sha256(txCopySerialized)
+			bodyHasher.update(uint32Struct.pack(hashType)) #uint32_t
 		elif hashType == SIGHASH.FORKID + SIGHASH.ALL:
 			if amount is None:
 				raise Exception('Please provide input amounts for SIGHASH_FORKID hashing')
 
 			#https://github.com/Bitcoin-UAHF/spec/blob/master/replay-protected-sighash.md
 
+			#Note: instead of constructing the whole signature body, it is fed
+			#into the hash function piece by piece.
+			bodyHasher = hashlib.sha256()
+			tx_in = self.tx_in[index]
+
 			#1. nVersion of the transaction (4-byte little endian)
-			signatureBody = struct.pack('<I', self.version) #version, uint32_t
+			bodyHasher.update(uint32Struct.pack(self.version)) #version, uint32_t
 
 			#2. hashPrevouts (32-byte hash)
 			#double SHA256 of the serialization of all input outpoints
-			signatureBody += SHA256(SHA256(''.join([
-				tx_in.previousOutputHash + struct.pack('<I', tx_in.previousOutputIndex) #uint32_t
-				for tx_in in self.tx_in
+			bodyHasher.update(self.__getCachedDoubleHash('hashPrevouts', ''.join([
+				t.previousOutputHash + uint32Struct.pack(t.previousOutputIndex) #uint32_t
+				for t in self.tx_in
 				])))
 
 			#3. hashSequence (32-byte hash)
 			#double SHA256 of the serialization of nSequence of all inputs
-			signatureBody += SHA256(SHA256(''.join([
-				struct.pack('<I', tx_in.sequenceNumber) #uint32_t
-				for tx_in in self.tx_in
-				])))
+			#(packed in a single struct.pack call, instead of one per input)
+			bodyHasher.update(self.__getCachedDoubleHash('hashSequence', struct.pack(
+				'<%dI' % len(self.tx_in), #uint32_t
+				*[t.sequenceNumber for t in self.tx_in]
+				)))
 
 			#4..7 are the input being signed (replacing the scriptSig with scriptCode + amount).
 
 			#4. outpoint (32-byte hash + 4-byte little endian)
 			#may already be contained in hashPrevouts
-			signatureBody += self.tx_in[index].previousOutputHash
-			signatureBody += struct.pack('<I', self.tx_in[index].previousOutputIndex) #uint32_t
+			bodyHasher.update(tx_in.previousOutputHash)
+			bodyHasher.update(uint32Struct.pack(tx_in.previousOutputIndex)) #uint32_t
 
 			#5. scriptCode of the input (serialized as scripts inside CTxOuts)
 			scriptPubKey_serialized = scriptPubKey.serialize()
-			signatureBody += packVarInt(len(scriptPubKey_serialized))
-			signatureBody += scriptPubKey_serialized
+			bodyHasher.update(packVarInt(len(scriptPubKey_serialized)))
+			bodyHasher.update(scriptPubKey_serialized)
 
 			#6. value of the output spent by this input (8-byte little endian)
-			signatureBody += struct.pack('<Q', amount) #uint64_t
-
 			#7. nSequence of the input (4-byte little endian)
 			#may already be contained in hashSequence
-			signatureBody += struct.pack('<I', self.tx_in[index].sequenceNumber) #uint32_t
+			bodyHasher.update(struct.pack('<QI',
+				amount, #uint64_t
+				tx_in.sequenceNumber #uint32_t
+				))
 
 			#8. hashOutputs (32-byte hash)
 			#double SHA256 of the serialization of all output amounts (8-byte little endian)
 			#paired up with their scriptPubKey (serialized as scripts inside CTxOuts)
-			signatureBody += SHA256(SHA256(''.join([
+			bodyHasher.update(self.__getCachedDoubleHash('hashOutputs', ''.join([
 				tx_out.serialize()
 				for tx_out in self.tx_out
 				])))
 
 			#9. nLocktime of the transaction (4-byte little endian)
-			signatureBody += struct.pack('<I', self.lockTime) #uint32_t
-
 			#10. sighash type of the signature (4-byte little endian)
 			#note: in UAHF, forkID = 0
-			signatureBody += struct.pack('<I', hashType) #uint32_t
+			bodyHasher.update(struct.pack('<II',
+				self.lockTime, #uint32_t
+				hashType #uint32_t
+				))
 
 		else:
 			raise Exception('hash type 0x%0x not supported' % hashType)
 
-		#This array is sha256 hashed twice,
-		bodyHash = SHA256(SHA256(signatureBody))
+		#This array is sha256 hashed twice (the first time is done in bodyHasher)
+		bodyHash = SHA256(bodyHasher.digest())
 
 		return bodyHash
 
@@ -707,7 +820,7 @@ class Transaction:
 		#Here we do the inverse - add hashType:
 		signatures = \
 		[
-			key.sign(bodyHash) + struct.pack('B', hashType) #uint8_t
+			key.sign(bodyHash) + chr(hashType) #uint8_t
 			for key in privateKeys
 		]
 
@@ -722,6 +835,6 @@ class Transaction:
 		str; the transaction ID. Note that the byte order is the reverse as
 		shown in Bitcoin.
 		"""
-		return SHA256(SHA256(self.serialize())) #Note: in Bitcoin, the tx hash is shown reversed!
+		return SHA256d(self.serialize()) #Note: in Bitcoin, the tx hash is shown reversed!
 
 
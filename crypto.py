@@ -29,7 +29,12 @@
 
 import threading
 import ctypes
+import hashlib
+import hmac
 
+#Note: functions loaded through ctypes.cdll (unlike ctypes.pydll) are called
+#with the GIL released, so other Python threads keep running during e.g.
+#signing, verification and public key derivation.
 libssl = ctypes.cdll.LoadLibrary("libssl.so") #Will be different on windows
 
 
@@ -140,11 +145,8 @@ libssl.ECDSA_verify.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
 	ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p]
 libssl.ECDSA_verify.restype = ctypes.c_int
 
-libssl.SHA256.argtypes = [ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p]
-libssl.SHA256.restype = ctypes.c_char_p
-
 libssl.RIPEMD160.argtypes = [ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p]
-libssl.RIPEMD160.restype = ctypes.c_char_p
+libssl.RIPEMD160.restype = ctypes.c_void_p #pointer to the output buffer; not converted to str
 
 libssl.d2i_ECPrivateKey.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_long]
 libssl.d2i_ECPrivateKey.restype = ctypes.c_void_p
@@ -242,9 +244,25 @@ def SHA256(data):
 	        (at least some cases of) the byte order used in Bitcoin.
 	"""
 
-	b = ctypes.create_string_buffer(32)
-	libssl.SHA256(data, len(data), b)
-	return ''.join(b)
+	return hashlib.sha256(data).digest()
+
+
+def SHA256d(data):
+	"""
+	Calculate the double SHA256 hash (SHA256 of SHA256) of given data, as used
+	in Bitcoin for transaction IDs, signature hashes and base58 checksums.
+
+	Arguments:
+	data : str; the data of which to calculate the double SHA256 hash
+
+	Return value:
+	str; the double SHA256 hash.
+	Note: this is in binary form (not hexadecimal).
+	Note 2: this is in OpenSSL's byte order, which is the reverse of
+	        (at least some cases of) the byte order used in Bitcoin.
+	"""
+
+	return hashlib.sha256(hashlib.sha256(data).digest()).digest()
 
 
 def RIPEMD160(data):
@@ -259,9 +277,32 @@ def RIPEMD160(data):
 	Note: this is in binary form (not hexadecimal).
 	"""
 
+	#Note: hashlib is not used here, since whether it supports RIPEMD160
+	#depends on the OpenSSL build it is linked against.
 	b = ctypes.create_string_buffer(20)
 	libssl.RIPEMD160(data, len(data), b)
-	return ''.join(b)
+	return b.raw
+
+
+def HASH160(data):
+	"""
+	Calculate the Bitcoin HASH160 (RIPEMD160 of SHA256) of given data, e.g.
+	the public key hash in Bitcoin addresses.
+
+	Arguments:
+	data : str; the data of which to calculate the HASH160
+
+	Return value:
+	str; the HASH160 hash.
+	Note: this is in binary form (not hexadecimal).
+	"""
+
+	#Equivalent to RIPEMD160(SHA256(data)), without the extra Python function
+	#call:
+	b = ctypes.create_string_buffer(20)
+	sha = hashlib.sha256(data).digest()
+	libssl.RIPEMD160(sha, len(sha), b)
+	return b.raw
 
 
 class Key:
@@ -284,6 +325,13 @@ class Key:
 		self.hasPrivateKey = False
 		self.hasCompressedPublicKey = False
 
+		#The data last given to setPublicKey, as long as that is still the
+		#current key; used to skip parsing the same public key again:
+		self.__publicKeyData = None
+
+		#Cached result of getPublicKey:
+		self.__publicKey = None
+
 		#keep a reference to ensure that we're deleted before libssl:
 		self.libssl = libssl
 
@@ -299,7 +347,57 @@ class Key:
 
 
 	#TODO: copy behavior
-	#TODO: comparison behavior
+
+
+	def __eq__(self, other):
+		"""
+		Compares two keys.
+		Keys are equal if they contain the same public key (including the
+		choice between compressed and non-compressed), and either both or
+		neither of them contain the private key. Since the public key follows
+		from the private key, the private keys don't need to be compared.
+		Note: the public keys are compared in constant time, using
+		hmac.compare_digest (the time does depend on their lengths). This
+		requires Python 2.7.7 or later.
+		Note 2: since Key is an old-style class that defines __eq__ but not
+		__hash__, Key objects are unhashable: they can't be put in sets or used
+		as dictionary keys. This is intentional, as Key objects are mutable.
+
+		Arguments:
+		other: Key; the key to compare with
+
+		Return value:
+		bool; indicates whether the keys are equal (True) or not (False)
+		"""
+
+		if not isinstance(other, Key):
+			return NotImplemented
+
+		if self.hasPublicKey != other.hasPublicKey or \
+			self.hasPrivateKey != other.hasPrivateKey:
+			return False
+
+		if not self.hasPublicKey:
+			return True
+
+		return hmac.compare_digest(self.getPublicKey(), other.getPublicKey())
+
+
+	def __ne__(self, other):
+		"""
+		Compares two keys; see __eq__.
+
+		Arguments:
+		other: Key; the key to compare with
+
+		Return value:
+		bool; indicates whether the keys are different (True) or not (False)
+		"""
+
+		ret = self.__eq__(other)
+		if ret is NotImplemented:
+			return ret
+		return not ret
 
 
 	def makeNewKey(self, compressed=True):
@@ -313,6 +411,9 @@ class Key:
 		Exception: key generating failed
 		"""
 
+		self.__publicKeyData = None
+		self.__publicKey = None
+
 		if not libssl.EC_KEY_generate_key(self.keyData):
 			raise Exception("EC_KEY_generate_key failed")
 
@@ -334,6 +435,8 @@ class Key:
 			POINT_CONVERSION_COMPRESSED if compressed else POINT_CONVERSION_UNCOMPRESSED
 			)
 		self.hasCompressedPublicKey = compressed
+		self.__publicKeyData = None
+		self.__publicKey = None
 
 
 	def setPublicKey(self, key):
@@ -350,6 +453,13 @@ class Key:
 		Exception: setting the key failed
 		"""
 
+		#Setting the same public key again is a no-op; this avoids repeating
+		#the (for compressed keys, relatively expensive) point decoding.
+		if key == self.__publicKeyData:
+			return
+		self.__publicKeyData = None
+		self.__publicKey = None
+
 		compressed = len(key) == 33
 
 		b = ctypes.create_string_buffer(key)
@@ -363,6 +473,7 @@ class Key:
 		self.setPublicKeyCompression(compressed)
 		self.hasPublicKey = True
 		self.hasPrivateKey = False
+		self.__publicKeyData = key
 
 
 	def getPublicKey(self):
@@ -379,6 +490,9 @@ class Key:
 		if not self.hasPublicKey:
 			raise Exception("Public key unknown")
 
+		if self.__publicKey is not None:
+			return self.__publicKey
+
 		size = libssl.i2o_ECPublicKey(self.keyData, None)
 		if not size:
 			raise Exception("i2o_ECPublicKey failed")
@@ -387,7 +501,8 @@ class Key:
 		if libssl.i2o_ECPublicKey(self.keyData, ctypes.byref(ctypes.pointer(b))) != size:
 			raise Exception("i2o_ECPublicKey returned unexpected size")
 
-		return ''.join(c for c in b)
+		self.__publicKey = b.raw
+		return self.__publicKey
 
 
 	def setPrivateKey(self, key):
@@ -404,6 +519,9 @@ class Key:
 		Exception: setting the key failed
 		"""
 
+		self.__publicKeyData = None
+		self.__publicKey = None
+
 		compressed = len(key) == 33
 		key = key[:32]
 
@@ -475,7 +593,7 @@ class Key:
 		if n != nBytes:
 			raise Exception("BN_bn2bin failed")
 
-		ret = "\0"*(32-nBytes) + ''.join(c for c in b)
+		ret = "\0"*(32-nBytes) + b.raw
 		if self.hasCompressedPublicKey:
 			ret += chr(1)
 		return ret
@@ -507,11 +625,11 @@ class Key:
 		if not self.hasPrivateKey:
 			raise Exception("private key unknown")
 
-		b_data = ctypes.create_string_buffer(data)
-
 		# https://github.com/bitcoin/bitcoin/blob/e0e14e43d9586409e42919f6cb955540134cda2a/src/key.cpp
 
-		sig = libssl.ECDSA_do_sign(ctypes.byref(b_data), len(data), self.keyData)
+		#Note: like in verify, data is passed without copying it into a ctypes
+		#buffer.
+		sig = libssl.ECDSA_do_sign(data, len(data), self.keyData)
 		if not sig:
 			raise Exception("ECDSA_do_sign failed")
 
@@ -547,7 +665,7 @@ class Key:
 		#print 'Size 2: ', size.value
 		libssl.ECDSA_SIG_free(sig)
 
-		return ''.join([b_sig[i] for i in range(size.value)]) #size contains actual size
+		return b_sig.raw[:size.value] #size contains actual size
 
 
 	def verify(self, data, signature):
@@ -569,10 +687,10 @@ class Key:
 		if not self.hasPublicKey:
 			raise Exception("public key unknown")
 
-		b_data = ctypes.create_string_buffer(data)
-
+		#Note: data and signature are passed without copying them into ctypes
+		#buffers; ctypes passes a pointer to the str contents.
 		# -1 = error, 0 = bad sig, 1 = good
-		result = libssl.ECDSA_verify(0, b_data, len(data), signature, len(signature), self.keyData)
+		result = libssl.ECDSA_verify(0, data, len(data), signature, len(signature), self.keyData)
 		if result == 1:
 			return True
 		if result == 0: